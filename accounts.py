@@ -10,17 +10,13 @@ BEARER_TOKEN = read_bearer_token()
 # Run once:
 #res = get_id_dict()
 
+# The timeline endpoint returns at most 100 tweets per page
+TIMELINE_PARAMS = dict(PARAMS, max_results="100")
+
 uids = get_most_recent_ids()
 done_uids = get_done_uids()
 
-for i, uid in enumerate(uids):
-    if str(uid) in done_uids:
-        continue
-    get_most_recent_tweets_account(uid, BEARER_TOKEN, PARAMS, 
-                                   verbose=True, save_file=True)
-    done_uids.append(str(uid))
-    if i%15 == 0 and i>1:
-        export_done_uids(done_uids)
-    print(done_uids)
-
-export_done_uids(done_uids)
\ No newline at end of file
+# Download timelines concurrently into json/timelines.jsonl
+done_uids = crawl_account_timelines(uids, BEARER_TOKEN, TIMELINE_PARAMS,
+                                    n_workers=8, done_uids=done_uids)
+print(f'{len(done_uids)} accounts downloaded.')
@@ -0,0 +1,277 @@
+"""
+Streaming hashtag, mention, URL and term statistics for all tweets.
+
+The stored pages (json/*.json search pages and the json/*.jsonl page
+stores written by the account crawler) are read one page at a time and
+aggregated into counters, so the corpus never has to be loaded into
+pandas. Counts, read progress, the IDs of counted tweets and the
+inverted term index are kept in a sqlite database, so that only the
+counts of the current run are held in memory. Progress is saved so
+that later runs only read new pages.
+"""
+import collections
+import glob
+import json
+import os
+import re
+import sqlite3
+
+import pandas as pd
+
+from profiling import profiled
+
+# Save progress so that statistics must not be recomputed from scratch
+ANALYTICS_PATH = './analytics.sqlite'
+
+COUNTERS = ['day', 'author', 'hashtag', 'mention', 'url', 'term']
+
+URL_PATTERN = re.compile(r'https?://\S+')
+HANDLE_PATTERN = re.compile(r'[@#]\w+')
+TERM_PATTERN = re.compile(r"[a-z][a-z0-9_']+")
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'from',
+    'has', 'have', 'i', 'in', 'is', 'it', 'its', 'of', 'on', 'or', 'our',
+    'rt', 'so', 'that', 'the', 'this', 'to', 'was', 'we', 'were', 'will',
+    'with', 'you', 'your', 'amp',
+}
+
+def open_db(db_path=ANALYTICS_PATH, reset=False):
+    """
+    Opens the sqlite database holding the counts per statistic, the
+    read progress per file, the IDs of all counted tweets and the
+    inverted term index (one (term, tweet ID) row per posting). If
+    reset, all tables are emptied.
+    """
+    db = sqlite3.connect(db_path)
+    if reset:
+        for table in ['counts', 'files', 'seen', 'postings']:
+            db.execute(f'DROP TABLE IF EXISTS {table}')
+    db.execute('CREATE TABLE IF NOT EXISTS counts (name TEXT, key TEXT, '\
+               'n INTEGER, PRIMARY KEY (name, key)) WITHOUT ROWID')
+    db.execute('CREATE TABLE IF NOT EXISTS files (file TEXT PRIMARY KEY, '\
+               'progress INTEGER)')
+    db.execute('CREATE TABLE IF NOT EXISTS seen (id INTEGER PRIMARY KEY)')
+    db.execute('CREATE TABLE IF NOT EXISTS postings (term TEXT, '\
+               'tweet_id INTEGER, PRIMARY KEY (term, tweet_id)) '\
+               'WITHOUT ROWID')
+    db.commit()
+    return db
+
+def new_state(db_path=ANALYTICS_PATH):
+    """
+    Returns an empty analytics state: the (emptied) database from
+    open_db() as 'db', the read progress per file and one
+    collections.Counter per statistic in COUNTERS. The counters only
+    hold counts that were not saved yet; use get_counts() for totals.
+    """
+    state = {name: collections.Counter() for name in COUNTERS}
+    state['files'] = dict()
+    state['db'] = open_db(db_path, reset=True)
+    return state
+
+def load_state(db_path=ANALYTICS_PATH):
+    """Loads the state saved by save_state() or returns a new one."""
+    if not os.path.exists(db_path):
+        return new_state(db_path)
+    state = {name: collections.Counter() for name in COUNTERS}
+    state['db'] = open_db(db_path)
+    state['files'] = dict(state['db'].execute('SELECT file, progress '\
+                                              'FROM files'))
+    return state
+
+def save_state(state):
+    """
+    Adds the unsaved counts and the read progress to the database
+    and commits them in the same transaction as the IDs and postings
+    of the counted tweets, so that an interrupted run loses either
+    all or none of them.
+    """
+    db = state['db']
+    for name in COUNTERS:
+        db.executemany('INSERT INTO counts VALUES (?, ?, ?) '\
+                       'ON CONFLICT (name, key) DO UPDATE '\
+                       'SET n = n + excluded.n',
+                       [(name, key, n) for key, n in state[name].items()])
+        state[name].clear()
+    db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?)',
+                   state['files'].items())
+    db.commit()
+    return
+
+def get_counts(state, name):
+    """
+    Returns the total counts of a statistic in COUNTERS (saved and
+    unsaved) as a collections.Counter.
+    """
+    rows = state['db'].execute('SELECT key, n FROM counts WHERE name = ?',
+                               (name,))
+    counts = collections.Counter(dict(rows))
+    counts.update(state[name])
+    return counts
+
+def tokenize(text):
+    """
+    Splits a tweet text into lower-case terms, leaving out URLs,
+    mentions, hashtags (which are counted from the tweet entities)
+    and STOPWORDS.
+    """
+    text = HANDLE_PATTERN.sub(' ', URL_PATTERN.sub(' ', text.lower()))
+    return [t for t in TERM_PATTERN.findall(text) if t not in STOPWORDS]
+
+def add_tweet(state, tweet):
+    """
+    Adds a single tweet (as returned in the 'data' list of an API
+    page) to the counters of the state.
+
+    Returns
+    -------
+    set
+        The terms of the tweet.
+    """
+    if 'created_at' in tweet:
+        state['day'][tweet['created_at'][:10]] += 1
+    if 'author_id' in tweet:
+        state['author'][tweet['author_id']] += 1
+
+    entities = tweet.get('entities', {})
+    for h in entities.get('hashtags', []):
+        state['hashtag'][h['tag'].lower()] += 1
+    for m in entities.get('mentions', []):
+        state['mention'][m['username'].lower()] += 1
+    for u in entities.get('urls', []):
+        state['url'][u.get('expanded_url', u['url'])] += 1
+
+    # Count each term once per tweet so that counts are document frequencies
+    terms = set(tokenize(tweet.get('text', '')))
+    state['term'].update(terms)
+    return terms
+
+def add_page(state, page, index_terms=True):
+    """
+    Adds the tweets of a page to the state. Tweets that were
+    already counted, e.g. because they matched several hashtag
+    queries, are skipped. The IDs of new tweets and their postings
+    are appended to the database.
+
+    Returns
+    -------
+    int
+        The number of tweets counted.
+    """
+    tweets = page.get('data', [])
+    if len(tweets) == 0:
+        return 0
+    db = state['db']
+    ids = [int(tweet['id']) for tweet in tweets]
+    query = f'SELECT id FROM seen WHERE id IN ({",".join("?"*len(ids))})'
+    seen = {row[0] for row in db.execute(query, ids)}
+
+    new_ids, postings = [], []
+    for tweet_id, tweet in zip(ids, tweets):
+        if tweet_id in seen:
+            continue
+        seen.add(tweet_id)
+        new_ids.append((tweet_id,))
+        terms = add_tweet(state, tweet)
+        if index_terms:
+            postings.extend((term, tweet_id) for term in terms)
+    db.executemany('INSERT INTO seen VALUES (?)', new_ids)
+    db.executemany('INSERT OR IGNORE INTO postings VALUES (?, ?)', postings)
+    return len(new_ids)
+
+def iter_new_pages(progress, folder='json'):
+    """
+    Yields all pages in folder that are not recorded as read in the
+    progress dict (e.g. state['files']), which is updated while
+    iterating. Pass an empty dict to read all pages. Page files
+    (*.json) are read once and recorded by their size. Page stores
+    (*.jsonl) are read from the byte offset reached in the previous
+    run, so that pages appended since are picked up. A trailing line
+    that is still being written is left for the next run.
+    """
+    for file in sorted(glob.glob(f'{folder}/*.json')):
+        size = os.path.getsize(file)
+        if progress.get(file) == size:
+            continue
+        with open(file) as f:
+            yield json.load(f)
+        progress[file] = size
+
+    for file in sorted(glob.glob(f'{folder}/*.jsonl')):
+        offset = progress.get(file, 0)
+        if os.path.getsize(file) < offset:
+            offset = 0 # The store was rewritten, tweets are deduplicated anyway
+        with open(file, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                if line.strip():
+                    yield json.loads(line)
+                progress[file] = offset
+
+@profiled
+def update(state=None, folder='json', index_terms=True, verbose=True):
+    """
+    Makes one pass over all new pages in folder and adds their
+    tweets to the state. Only the counters and the current page
+    are held in memory. Call save_state() to keep the results.
+
+    Parameters
+    ----------
+    state : dict
+        A state from new_state() or load_state(). Defaults to the
+        state saved at ANALYTICS_PATH.
+    folder : str
+        The folder holding the downloaded pages. Defaults to 'json'.
+    index_terms : bool
+        A boolean indicating whether postings should be added to
+        the inverted term index. Defaults to True.
+    verbose : bool
+        A boolean indicating whether the number of new tweets should
+        be printed to the console. Defaults to True.
+
+    Returns
+    -------
+    dict
+        The updated state.
+    """
+    if state is None:
+        state = load_state()
+    n_pages, n_tweets = 0, 0
+    for page in iter_new_pages(state['files'], folder):
+        n_pages += 1
+        n_tweets += add_page(state, page, index_terms=index_terms)
+    if verbose:
+        print(f'Added {n_tweets} new tweets from {n_pages} pages.')
+    return state
+
+def lookup(state, *terms):
+    """Returns the sorted IDs of all tweets containing all terms."""
+    if len(terms) == 0:
+        return []
+    query = ' INTERSECT '.join(['SELECT tweet_id FROM postings '\
+                                'WHERE term = ?'] * len(terms))
+    rows = state['db'].execute(query, [t.lower() for t in terms])
+    return sorted(row[0] for row in rows)
+
+def export_tables(state, prefix='./ngss-analytics'):
+    """
+    Writes one csv file per statistic in COUNTERS (e.g.
+    ngss-analytics-hashtag.csv) with the statistic and its count n,
+    sorted by descending count (per-day counts by date).
+    """
+    for name in COUNTERS:
+        dd = pd.DataFrame(get_counts(state, name).most_common(), 
+                          columns=[name, 'n'])
+        if name == 'day':
+            dd = dd.sort_values('day')
+        dd.to_csv(f'{prefix}-{name}.csv', index=False)
+    return
+
+if __name__ == '__main__':
+    state = update()
+    save_state(state)
+    export_tables(state)
+    print(get_counts(state, 'hashtag').most_common(20))
@@ -0,0 +1,288 @@
+"""
+Micro-benchmarks for the parsing and export hot paths.
+
+Generates synthetic API pages, link csv files and embedding sets at
+the requested scale in a temporary folder, times every benchmark
+(best of --repeat runs) and measures its peak memory with tracemalloc
+in a separate run. The report is written to a json file that can be
+compared against the report of an earlier run:
+
+    python benchmarks.py --scale 10k
+    python benchmarks.py --scale 10k --compare bench-10k_<time>.json
+
+Benchmarks that would take hours at large scales (e.g. the per-row
+data frame construction of embeddings.py) are capped, see BENCHMARKS.
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+SCALES = {'10k': 10000, '100k': 100000, '1M': 1000000}
+TWEETS_PER_PAGE = 500
+EMBEDDING_DIM = 384
+WORDS = ['science', 'students', 'teachers', 'lesson', 'phenomena', 'model',
+         'inquiry', 'engineering', 'design', 'classroom', 'standards',
+         'learning', 'data', 'evidence', 'argument', 'energy', 'earth']
+HASHTAGS = ['ngss', 'ngsschat', 'scichat', 'stem', 'edchat']
+
+def make_tweet(tweet_id, rng, n_authors=1000):
+    """Returns a synthetic tweet with the fields requested in main.py."""
+    words = list(rng.choice(WORDS, size=rng.integers(5, 20)))
+    tags = list(rng.choice(HASHTAGS, size=rng.integers(0, 3), replace=False))
+    author = str(rng.integers(n_authors))
+    tweet = {
+        'id': str(tweet_id),
+        'text': ' '.join(words + [f'#{t}' for t in tags] +
+                         [f'@user{author} https://t.co/{tweet_id}']),
+        'author_id': author,
+        'created_at': f'2022-{rng.integers(1, 13):02d}-'\
+                      f'{rng.integers(1, 29):02d}T12:00:00.000Z',
+        'conversation_id': str(tweet_id),
+        'lang': 'en',
+        'public_metrics': {'retweet_count': int(rng.integers(10)),
+                           'reply_count': int(rng.integers(3)),
+                           'like_count': int(rng.integers(50)),
+                           'quote_count': 0},
+        'entities': {
+            'hashtags': [{'start': 0, 'end': 0, 'tag': t} for t in tags],
+            'mentions': [{'start': 0, 'end': 0, 'username': f'user{author}',
+                          'id': author}],
+            'urls': [{'start': 0, 'end': 0, 'url': f'https://t.co/{tweet_id}',
+                      'expanded_url': f'https://example.org/{tweet_id % 97}'}],
+        },
+    }
+    # Every third tweet replies to an earlier tweet
+    if tweet_id % 3 == 0 and tweet_id > 10:
+        parent = tweet_id - int(rng.integers(1, 10))
+        tweet['conversation_id'] = str(parent - parent % 10)
+        tweet['referenced_tweets'] = [{'type': 'replied_to', 'id': str(parent)}]
+    return tweet
+
+def make_pages(n_tweets, rng, per_page=TWEETS_PER_PAGE):
+    """Returns synthetic search pages with n_tweets tweets in total."""
+    pages = []
+    for first in range(0, n_tweets, per_page):
+        ids = range(first + 1, min(first + per_page, n_tweets) + 1)
+        data = [make_tweet(i, rng) for i in ids]
+        pages.append({'data': data, 'includes': {'users': []},
+                      'meta': {'newest_id': data[-1]['id'],
+                               'oldest_id': data[0]['id'],
+                               'result_count': len(data)}})
+    return pages
+
+def write_pages(pages, folder='json'):
+    os.makedirs(folder, exist_ok=True)
+    for i, page in enumerate(pages):
+        with open(f'{folder}/#ngss_{i}.json', 'w') as f:
+            json.dump(page, f, ensure_ascii=False)
+
+def make_link_csv(n_rows, rng, f='12-2022-twitter-links.csv'):
+    """Writes a link csv as read by utils.get_url_ids()."""
+    users = rng.integers(n_rows // 2 + 1, size=n_rows)
+    links = [f'https://twitter.com/User{u}/status/{i}'
+             for i, u in enumerate(users)]
+    pd.DataFrame({'scraped_links': links}).to_csv(f, index=False)
+
+def make_done_uids(n_uids, n_files=50):
+    """Writes done uid files as read by utils.get_done_uids()."""
+    for i in range(n_files):
+        uids = range(n_uids * (i + 1) // n_files)
+        pd.DataFrame({'uid': uids}).to_csv(
+            f'twitter-done-uids-2023-01-{i:04d}.csv', index=False)
+
+def make_embeddings(n, rng, dim=EMBEDDING_DIM):
+    """Returns synthetic status IDs and a float32 embedding matrix."""
+    ids = np.arange(n).astype(str)
+    X = rng.standard_normal((n, dim), dtype=np.float32)
+    # Duplicate every 20th vector to give the deduplication work
+    X[1::20] = X[::20][:len(X[1::20])]
+    return ids, X
+
+def bench_json_loads(n, rng):
+    contents = [json.dumps(p) for p in make_pages(n, rng)]
+    return lambda: [json.loads(c) for c in contents]
+
+def bench_json_normalize(n, rng):
+    pages = make_pages(n, rng)
+    return lambda: [pd.json_normalize(p['data']) for p in pages]
+
+def bench_embeddings_frame(n, rng):
+    ids, X = make_embeddings(n, rng)
+    d_emb = {key: row.tolist() for key, row in zip(ids, X)}
+    def run():
+        # Same construction as in embeddings.py
+        rows = [pd.DataFrame([key] + d_emb[key]).T for key in d_emb]
+        return pd.concat(rows)
+    return run
+
+def bench_get_url_ids(n, rng):
+    import utils
+    make_link_csv(n, rng)
+    return utils.get_url_ids
+
+def bench_get_done_uids(n, rng):
+    import utils
+    make_done_uids(n)
+    return utils.get_done_uids
+
+def bench_analytics_update(n, rng):
+    import analytics
+    write_pages(make_pages(n, rng))
+    def run():
+        state = analytics.update(analytics.new_state(), verbose=False)
+        analytics.save_state(state)
+        state['db'].close()
+    return run
+
+def bench_build_index(n, rng):
+    import conversations
+    write_pages(make_pages(n, rng))
+    return conversations.build_index
+
+def bench_load_embedding_matrix(n, rng):
+    import clusters
+    ids, X = make_embeddings(n, rng)
+    out = pd.DataFrame(X)
+    out.insert(0, 'status_id', ids)
+    out.to_csv(clusters.EMBEDDINGS_CSV, index=False)
+    return clusters.load_embedding_matrix
+
+def bench_fit_clusters(n, rng):
+    import clusters
+    _, X = make_embeddings(n, rng)
+    X /= np.linalg.norm(X, axis=1, keepdims=True)
+    return lambda: clusters.fit_clusters(X)
+
+def bench_find_duplicates(n, rng):
+    import clusters
+    _, X = make_embeddings(n, rng)
+    X /= np.linalg.norm(X, axis=1, keepdims=True)
+    # Use the clusters of the real stage so that their balance counts
+    labels = clusters.fit_clusters(X)
+    return lambda: clusters.find_duplicates(X, labels)
+
+# name -> (setup function returning the benchmark, maximum number of items)
+BENCHMARKS = {
+    'json_loads': (bench_json_loads, None),
+    'json_normalize': (bench_json_normalize, None),
+    'embeddings_frame': (bench_embeddings_frame, 10000),
+    'get_url_ids': (bench_get_url_ids, None),
+    'get_done_uids': (bench_get_done_uids, None),
+    'analytics_update': (bench_analytics_update, None),
+    'build_index': (bench_build_index, None),
+    'load_embedding_matrix': (bench_load_embedding_matrix, 100000),
+    'fit_clusters': (bench_fit_clusters, None),
+    'find_duplicates': (bench_find_duplicates, None),
+}
+
+def measure(run, repeat=3):
+    """
+    Returns the best wall time of repeat runs and the peak memory
+    (in MB) traced during one additional run.
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(seconds), peak / 2**20
+
+def run_benchmarks(scale='10k', names=None, repeat=3, seed=0):
+    """
+    Runs the benchmarks in names (defaults to all BENCHMARKS) at
+    the given scale in a temporary working directory.
+
+    Returns
+    -------
+    dict
+        The report with one entry per benchmark holding the number
+        of items, the best time, the throughput and the peak memory.
+    """
+    n = SCALES[scale]
+    names = list(BENCHMARKS) if names is None else names
+    report = {'scale': scale, 'repeat': repeat, 'python': sys.version,
+              'started': datetime.datetime.now().isoformat(), 'results': {}}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            # utils.py reads the token on import
+            with open('bearer_token.txt', 'w') as f:
+                f.write('benchmark\n')
+            import utils
+            for name in names:
+                setup, cap = BENCHMARKS[name]
+                items = n if cap is None else min(n, cap)
+                os.makedirs(name)
+                os.chdir(name)
+                run = setup(items, np.random.default_rng(seed))
+                seconds, peak_mb = measure(run, repeat=repeat)
+                os.chdir(tmp)
+                report['results'][name] = {
+                    'items': items, 'seconds': seconds,
+                    'items_per_s': items / seconds, 'peak_mb': peak_mb}
+                print(f'{name:>22}: {items:>8} items {seconds:9.3f} s '\
+                      f'{items/seconds:12.0f} items/s {peak_mb:9.1f} MB')
+        finally:
+            os.chdir(cwd)
+    return report
+
+def compare_reports(old, new, tolerance=0.2):
+    """
+    Prints the ratio of time and peak memory of new over old for
+    every benchmark in both reports with the same number of items.
+
+    Returns
+    -------
+    list
+        The names of benchmarks that got slower or used more memory
+        by more than tolerance.
+    """
+    regressions = []
+    for name, res in new['results'].items():
+        ref = old['results'].get(name)
+        if ref is None or ref['items'] != res['items']:
+            continue
+        time_ratio = res['seconds'] / ref['seconds']
+        memory_ratio = res['peak_mb'] / max(ref['peak_mb'], 1e-6)
+        flag = ''
+        if time_ratio > 1 + tolerance or memory_ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = '  <- regression'
+        print(f'{name:>22}: time x{time_ratio:.2f} memory '\
+              f'x{memory_ratio:.2f}{flag}')
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scale', choices=SCALES, default='10k')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--compare', help='an earlier report to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.scale, args.only, args.repeat)
+    fn = f"bench-{args.scale}_"\
+         f"{datetime.datetime.now().strftime('%Y-%m-%d_%H:%M:%S')}.json"
+    print(f'Saving report to {fn}')
+    with open(fn, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        if compare_reports(old, report, args.tolerance):
+            sys.exit(1)
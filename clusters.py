@@ -0,0 +1,173 @@
+"""
+Topic clusters and near-duplicate groups for all tweet embeddings.
+
+Reads the embeddings exported by embeddings.py, groups them with
+mini-batch k-means and collapses near-duplicates (bot spam, templated
+posts) within each cluster. Similarities are computed in blocks of
+rows and columns so that memory stays bounded for millions of tweets,
+and the number of clusters grows with the number of tweets so that
+the comparisons within clusters do not grow quadratically.
+"""
+import numpy as np
+import pandas as pd
+
+from sklearn.cluster import MiniBatchKMeans
+
+from profiling import profiled
+
+EMBEDDINGS_CSV = './sentence-embeddings-ngss.csv'
+
+# Average cluster size, which bounds the comparisons per row
+ROWS_PER_CLUSTER = 2000
+
+@profiled
+def load_embedding_matrix(f=EMBEDDINGS_CSV, chunksize=100000):
+    """
+    Reads the embeddings csv in chunks into a float32 matrix with
+    L2-normalized rows, so that dot products are cosine similarities
+    and k-means on the rows clusters by cosine similarity. The matrix
+    is allocated once (the rows are counted in a first pass over the
+    file) and filled chunk by chunk.
+
+    Returns
+    -------
+    tuple
+        The status IDs (numpy array of str) and the matrix.
+    """
+    with open(f, 'rb') as handle:
+        n_dims = len(handle.readline().split(b',')) - 1
+        n_rows = sum(1 for line in handle if line.strip())
+    ids = np.empty(n_rows, dtype=object)
+    X = np.empty((n_rows, n_dims), dtype=np.float32)
+    start = 0
+    for chunk in pd.read_csv(f, chunksize=chunksize,
+                             dtype={'status_id': str}):
+        stop = start + len(chunk)
+        ids[start:stop] = chunk.pop('status_id').to_numpy()
+        X[start:stop] = chunk.to_numpy(dtype=np.float32)
+        norms = np.linalg.norm(X[start:stop], axis=1, keepdims=True)
+        X[start:stop] /= np.maximum(norms, 1e-12)
+        start = stop
+    return ids.astype(str), X
+
+@profiled
+def fit_clusters(X, n_clusters=None, batch_size=4096, n_epochs=3,
+                 chunksize=100000, random_state=0):
+    """
+    Trains mini-batch k-means with partial_fit() on batches of
+    batch_size rows (visited in random order for n_epochs passes)
+    and then assigns the rows to clusters chunksize rows at a time,
+    so that no copy of X is made. The number of clusters defaults
+    to one per ROWS_PER_CLUSTER rows (at least 100) and is capped
+    at the number of rows.
+
+    Returns
+    -------
+    numpy.ndarray
+        The cluster label of every row of X.
+    """
+    n = len(X)
+    if n == 0:
+        return np.zeros(0, dtype=np.int32)
+    if n_clusters is None:
+        n_clusters = max(100, n // ROWS_PER_CLUSTER)
+    n_clusters = min(n_clusters, n)
+    # The first batch initializes the centers and needs n_clusters rows
+    batch_size = max(batch_size, n_clusters)
+    km = MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size,
+                         random_state=random_state)
+    rng = np.random.default_rng(random_state)
+    starts = np.arange(0, n, batch_size)
+    km.partial_fit(X[:batch_size])
+    for _ in range(n_epochs):
+        for start in rng.permutation(starts):
+            km.partial_fit(X[start:start + batch_size])
+
+    labels = np.empty(n, dtype=np.int32)
+    for start in range(0, n, chunksize):
+        labels[start:start + chunksize] = km.predict(X[start:start + chunksize])
+    return labels
+
+@profiled
+def find_duplicates(X, labels, threshold=0.95, max_block_size=2**25):
+    """
+    Groups near-duplicate rows of X within each cluster. Rows are
+    visited in order; a row that is not yet part of a group starts a
+    new one and takes in all later rows of its cluster with a cosine
+    similarity of at least threshold. Near-duplicates in different
+    clusters are not compared.
+
+    Parameters
+    ----------
+    X : numpy.ndarray
+        The L2-normalized embedding matrix.
+    labels : numpy.ndarray
+        The cluster label of every row.
+    threshold : float
+        The minimum cosine similarity of near-duplicates. Defaults
+        to 0.95.
+    max_block_size : int
+        The maximum number of similarities computed at once and of
+        values in the rows gathered for them (2**25 float32 values
+        are 128 MB).
+
+    Returns
+    -------
+    numpy.ndarray
+        For every row, the position of the first row of its
+        duplicate group (its own position if it is unique).
+    """
+    groups = np.full(len(X), -1, dtype=np.int64)
+    order = np.argsort(labels, kind='stable')
+    bounds = np.flatnonzero(np.diff(labels[order])) + 1
+    for members in np.split(order, bounds):
+        m = len(members)
+        if m == 0:
+            continue
+        # Blocks of rows are compared to chunks of the later rows
+        n_rows = max(1, min(m, int(np.sqrt(max_block_size))))
+        n_cols = max(n_rows, max_block_size // max(n_rows, X.shape[1]))
+        for start in range(0, m, n_rows):
+            block = members[start:start + n_rows]
+            X_block = X[block]
+            for col_start in range(start, m, n_cols):
+                cols = members[col_start:col_start + n_cols]
+                S = X_block @ X[cols].T
+                for i, row in enumerate(block):
+                    if col_start == start:
+                        # The first chunk holds the block itself and
+                        # decides which of its rows start a group
+                        if groups[row] != -1:
+                            continue
+                        dup = cols[i:][S[i, i:] >= threshold]
+                    elif groups[row] != row:
+                        continue
+                    else:
+                        dup = cols[S[i] >= threshold]
+                    dup = dup[groups[dup] == -1]
+                    groups[dup] = row
+                    groups[row] = row
+    return groups
+
+def export_clusters(ids, labels, groups, f=EMBEDDINGS_CSV):
+    """
+    Writes the cluster and the duplicate group (the status ID of
+    the first tweet of the group) of every tweet to a csv file
+    next to the embeddings, e.g. sentence-embeddings-ngss-clusters.csv.
+    Tweets with status_id == duplicate_of are the ones to keep when
+    collapsing near-duplicates.
+    """
+    out = pd.DataFrame({'status_id': ids, 'cluster': labels,
+                        'duplicate_of': ids[groups]})
+    fn = f.replace('.csv', '-clusters.csv')
+    print(f'Saving file to {fn}')
+    out.to_csv(fn, index=False)
+    return out
+
+if __name__ == '__main__':
+    ids, X = load_embedding_matrix()
+    labels = fit_clusters(X)
+    groups = find_duplicates(X, labels)
+    out = export_clusters(ids, labels, groups)
+    n_unique = (out.status_id == out.duplicate_of).sum()
+    print(f'{len(out)} tweets, {n_unique} after collapsing near-duplicates.')
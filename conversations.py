@@ -0,0 +1,249 @@
+"""
+Index of all stored tweets by conversation and reply structure.
+
+The index is used to decide which conversations still have to be
+downloaded (see extract_and_download_conversation_ids() in utils.py):
+conversations that consist of a root without replies are skipped,
+conversations downloaded before are only re-checked for replies newer
+than the newest downloaded tweet if stored tweets show new activity.
+"""
+import glob
+import json
+import os
+import time
+
+from array import array
+
+import numpy as np
+import pandas as pd
+
+from analytics import iter_new_pages
+from profiling import profiled
+
+# Conversation ID -> [newest downloaded tweet ID, time of download,
+#                     number of downloaded tweets]
+FETCHED_PATH = './conversations-fetched.json'
+
+# Start of tweet IDs (snowflakes) in milliseconds since the epoch
+TWITTER_EPOCH = 1288834974657
+
+def tweet_time(tweet_id):
+    """Returns the creation time of a tweet ID in seconds since the epoch."""
+    return ((int(tweet_id) >> 22) + TWITTER_EPOCH) / 1000
+
+class ConversationIndex:
+    """
+    Stores one row per tweet in flat int64 numpy arrays (tweet ID,
+    conversation ID, ID of the tweet replied to or 0, and the reply
+    count from the public metrics or -1 if unknown), sorted by
+    conversation and tweet ID. Tweets of a conversation therefore
+    form one contiguous block, and since tweet IDs increase over
+    time the last tweet of a block is the newest one.
+
+    Parameters
+    ----------
+    ids, conversation_ids, parent_ids, reply_counts : array-like
+        One entry per tweet. Duplicate tweet IDs are dropped, keeping
+        the largest reply count of all copies (copies may be older
+        snapshots taken before the tweet got replies).
+    """
+    def __init__(self, ids, conversation_ids, parent_ids, reply_counts):
+        ids = np.asarray(ids, dtype=np.int64)
+        by_id = np.argsort(ids, kind='stable')
+        _, first = np.unique(ids[by_id], return_index=True)
+        reply_counts = np.maximum.reduceat(
+            np.asarray(reply_counts, dtype=np.int64)[by_id], first) \
+            if len(ids) > 0 else np.zeros(0, dtype=np.int64)
+        first = by_id[first]
+        conversation_ids = np.asarray(conversation_ids, dtype=np.int64)[first]
+        order = np.lexsort((ids[first], conversation_ids))
+        keep = first[order]
+
+        self.ids = ids[keep]
+        self.conversation_ids = conversation_ids[order]
+        self.parent_ids = np.asarray(parent_ids, dtype=np.int64)[keep]
+        self.reply_counts = reply_counts[order]
+
+        self.conversations, self.starts, self.sizes = np.unique(
+            self.conversation_ids, return_index=True, return_counts=True)
+        self.newest_ids = self.ids[self.starts + self.sizes - 1]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _position(self, conv_id):
+        i = np.searchsorted(self.conversations, int(conv_id))
+        if i < len(self.conversations) and self.conversations[i] == int(conv_id):
+            return i
+        return None
+
+    def tweets(self, conv_id):
+        """Returns the sorted IDs of all stored tweets of a conversation."""
+        i = self._position(conv_id)
+        if i is None:
+            return self.ids[:0]
+        return self.ids[self.starts[i]:self.starts[i] + self.sizes[i]]
+
+    def newest_id(self, conv_id):
+        """Returns the newest stored tweet ID of a conversation or None."""
+        i = self._position(conv_id)
+        return None if i is None else int(self.newest_ids[i])
+
+    def reply_count(self, conv_id):
+        """
+        Returns the reply count of the root tweet of a conversation,
+        or -1 if the root tweet or its public metrics are not stored.
+        """
+        i = self._position(conv_id)
+        if i is None or self.ids[self.starts[i]] != int(conv_id):
+            return -1
+        return int(self.reply_counts[self.starts[i]])
+
+    def reply_tree(self, conv_id):
+        """
+        Returns the reply tree of a conversation as two arrays: the
+        sorted tweet IDs and, for each tweet, the position of the
+        tweet it replies to in the first array (-1 for the root and
+        for replies to tweets that are not stored).
+        """
+        i = self._position(conv_id)
+        if i is None:
+            return self.ids[:0], self.ids[:0]
+        block = slice(self.starts[i], self.starts[i] + self.sizes[i])
+        ids, parent_ids = self.ids[block], self.parent_ids[block]
+        pos = np.searchsorted(ids, parent_ids)
+        found = pos < len(ids)
+        found[found] = ids[pos[found]] == parent_ids[found]
+        return ids, np.where(found, pos, -1)
+
+@profiled
+def build_index(folder='json'):
+    """
+    Makes one pass over all stored pages in folder (see
+    analytics.iter_new_pages()) and indexes the tweets in 'data'
+    and the referenced tweets in 'includes'. Tweets without a
+    conversation_id (i.e. not requested in tweet.fields) are left
+    out.
+
+    Parameters
+    ----------
+    folder : str
+        The folder holding the downloaded pages. Defaults to 'json'.
+
+    Returns
+    -------
+    ConversationIndex
+        The index of all stored tweets.
+    """
+    ids, conv_ids = array('q'), array('q')
+    parent_ids, reply_counts = array('q'), array('q')
+    for page in iter_new_pages(dict(), folder):
+        tweets = page.get('data', []) + page.get('includes', {}).get('tweets', [])
+        for tweet in tweets:
+            if 'conversation_id' not in tweet:
+                continue
+            parent = 0
+            for ref in tweet.get('referenced_tweets', []):
+                if ref['type'] == 'replied_to':
+                    parent = int(ref['id'])
+            ids.append(int(tweet['id']))
+            conv_ids.append(int(tweet['conversation_id']))
+            parent_ids.append(parent)
+            reply_counts.append(tweet.get('public_metrics', {})
+                                     .get('reply_count', -1))
+    return ConversationIndex(ids, conv_ids, parent_ids, reply_counts)
+
+def seed_fetched(pattern='Conversations_*.csv'):
+    """
+    Builds a download log from the csv files written by
+    get_conversations() in utils.py, so that conversations downloaded
+    before the log existed are not downloaded again. The time of
+    download is taken from the file modification time.
+    """
+    fetched = dict()
+    for file in sorted(glob.glob(pattern), key=os.path.getmtime):
+        try:
+            tmp = pd.read_csv(file, usecols=['id', 'conversation_id'], 
+                              dtype=str).dropna()
+        except (ValueError, pd.errors.EmptyDataError):
+            continue
+        checked = os.path.getmtime(file)
+        tmp['id'] = tmp['id'].map(int)
+        for conv_id, ids in tmp.groupby('conversation_id')['id']:
+            fetched[conv_id] = [int(ids.max()), checked, len(ids)]
+    return fetched
+
+def load_fetched(f=FETCHED_PATH):
+    """
+    Loads the download log, or seeds it from earlier csv downloads
+    (see seed_fetched()) if it does not exist yet.
+    """
+    if not os.path.exists(f):
+        return seed_fetched()
+    with open(f, 'r') as handle:
+        d_in = json.load(handle)
+    return d_in
+
+def save_fetched(d_out, f=FETCHED_PATH):
+    with open(f, 'w') as handle:
+        json.dump(d_out, handle)
+    return
+
+def select_conversations(conv_ids, index, fetched, max_age_days=7,
+                         max_activity_days=90):
+    """
+    Selects the conversations that have to be downloaded.
+
+    Conversations that were never downloaded are requested in full,
+    unless the index holds only the root tweet and its reply count
+    is 0. Downloaded conversations are requested again, for replies
+    newer than the newest downloaded tweet only, if all of the following
+    hold:
+
+    - they were downloaded more than max_age_days ago,
+    - stored tweets show new activity: the index holds a tweet newer
+      than the newest downloaded one, or the root's reply count is
+      higher than the number of downloaded tweets,
+    - their newest known tweet is at most max_activity_days old.
+
+    Parameters
+    ----------
+    conv_ids : iterable
+        The candidate conversation IDs.
+    index : ConversationIndex
+        The index of all stored tweets.
+    fetched : dict
+        The download log from load_fetched().
+    max_age_days : float
+        The number of days after which a download may be repeated.
+        Defaults to 7.
+    max_activity_days : float
+        The number of days after the newest known tweet after which
+        a conversation is not checked anymore. Defaults to 90.
+
+    Returns
+    -------
+    dict
+        Conversation ID -> since_id (None for full downloads).
+    """
+    now = time.time()
+    todo = dict()
+    for conv_id in conv_ids:
+        key = str(conv_id)
+        if key not in fetched:
+            if len(index.tweets(conv_id)) != 1 or index.reply_count(conv_id) != 0:
+                todo[conv_id] = None
+            continue
+        newest_id, checked, n_tweets = fetched[key]
+        if now - checked < max_age_days*24*60*60:
+            continue
+        newest_stored = index.newest_id(conv_id) or 0
+        if newest_stored <= newest_id and index.reply_count(conv_id) <= n_tweets:
+            continue
+        last_activity = tweet_time(max(newest_id, newest_stored))
+        if now - last_activity > max_activity_days*24*60*60:
+            continue
+        # Stored tweets may come from other sources (e.g. a hashtag 
+        # search), so only the downloaded ones bound the request
+        todo[conv_id] = newest_id or None
+    return todo
@@ -10,6 +10,9 @@ import pandas as pd
 from tqdm import tqdm
 
 from sentence_transformers import SentenceTransformer
+
+from profiling import profile
+
 model = SentenceTransformer('paraphrase-MiniLM-L6-v2', device='cpu')
 
 # Save progress so that embeddings must not be generated in one session
@@ -35,32 +38,35 @@ except:
     save_embeddings(d_emb)
 
 # Read texts
-files = glob.glob('json/*.json')
-for file in tqdm(files):
-    with open(file) as f:
-        d = json.load(f)
-    for tweet in d['data']:
-        d_tweet[tweet['id']] = tweet['text']
+with profile('embeddings.read'):
+    files = glob.glob('json/*.json')
+    for file in tqdm(files):
+        with open(file) as f:
+            d = json.load(f)
+        for tweet in d['data']:
+            d_tweet[tweet['id']] = tweet['text']
 
 # Encode texts, make breaks to not strain CPU
 count = 0
-for key in tqdm(d_tweet.keys()):
-    # Every 10k encodings
-    #if count//10000:
-    #    save_embeddings(d_emb)
-    #    time.sleep(60*3) # sleep 3 mins
-    if key not in d_emb:
-        d_emb[key] = model.encode(d_tweet[key]).tolist()
-        count += 1
+with profile('embeddings.encode'):
+    for key in tqdm(d_tweet.keys()):
+        # Every 10k encodings
+        #if count//10000:
+        #    save_embeddings(d_emb)
+        #    time.sleep(60*3) # sleep 3 mins
+        if key not in d_emb:
+            d_emb[key] = model.encode(d_tweet[key]).tolist()
+            count += 1
 
 # Create DF
-rows = []
-for key in tqdm(d_tweet.keys()):
-    if key not in d_emb:
-        continue
-    rows.append(pd.DataFrame([key] + d_emb[key]).T)
+with profile('embeddings.export'):
+    rows = []
+    for key in tqdm(d_tweet.keys()):
+        if key not in d_emb:
+            continue
+        rows.append(pd.DataFrame([key] + d_emb[key]).T)
 
-# Export
-out = pd.concat(rows)  
-out.columns = ['status_id'] + ['text_emb_dim_' + str(i) for i in range(1, out.shape[1])]
-out.to_csv('./sentence-embeddings-ngss.csv', index=False)
+    # Export
+    out = pd.concat(rows)  
+    out.columns = ['status_id'] + ['text_emb_dim_' + str(i) for i in range(1, out.shape[1])]
+    out.to_csv('./sentence-embeddings-ngss.csv', index=False)
@@ -0,0 +1,163 @@
+"""
+Opt-in profiling of pipeline stages.
+
+Profiling is switched off unless the environment variable NGSS_PROFILE
+is set to 'cprofile', 'tracemalloc' or 'cprofile,tracemalloc', e.g.
+
+    NGSS_PROFILE=cprofile,tracemalloc python analytics.py
+
+Every stage wrapped in profile() or decorated with profiled() then
+writes its reports to NGSS_PROFILE_DIR (defaults to ./profiles) and
+appends its wall time and peak memory to summary.jsonl there, so that
+runs can be compared. Nested stages are profiled as part of the
+outermost one, and only one stage is profiled at a time. Functions
+that run in worker threads of a stage are decorated with
+profiled_worker() so that cProfile sees them as well. Profiling never
+raises into the profiled code: if it fails, a warning is issued and
+the stage runs unprofiled.
+"""
+import cProfile
+import contextlib
+import datetime
+import functools
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+import warnings
+
+PROFILE = [m.strip() for m in os.environ.get('NGSS_PROFILE', '').split(',')
+           if m.strip()]
+PROFILE_DIR = os.environ.get('NGSS_PROFILE_DIR', './profiles')
+
+# From Python 3.12 on, cProfile uses sys.monitoring: a profiler sees all
+# threads, but only one profiler can be active at a time
+PROFILER_SEES_THREADS = sys.version_info >= (3, 12)
+
+# The stage that is currently profiled, guarded by _lock
+_active = None
+_lock = threading.Lock()
+
+@contextlib.contextmanager
+def profile(name):
+    """
+    A context manager that profiles the enclosed code as the stage
+    name if profiling is switched on through NGSS_PROFILE. Before
+    Python 3.12, cProfile only sees the calling thread; code running
+    in worker threads is included if it is wrapped in
+    profile_worker().
+    """
+    global _active
+    with _lock:
+        if not PROFILE or _active is not None:
+            stage = None
+        else:
+            stage = _active = {'thread': threading.get_ident(),
+                               'profilers': []}
+    if stage is None:
+        yield
+        return
+    try:
+        stamp = datetime.datetime.now().strftime('%Y-%m-%d_%H:%M:%S_%f')
+        fn = f'{PROFILE_DIR}/{name}_{stamp}'
+
+        profiler = cProfile.Profile() if 'cprofile' in PROFILE else None
+        trace = 'tracemalloc' in PROFILE and not tracemalloc.is_tracing()
+        if trace:
+            tracemalloc.start()
+        if profiler is not None:
+            try:
+                profiler.enable()
+            except ValueError as e:
+                # Another profiler (e.g. a debugger) is active
+                warnings.warn(f'Not profiling {name} with cProfile: {e}')
+                profiler = None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+            try:
+                _write_reports(name, stamp, fn, seconds, profiler, trace, 
+                               stage['profilers'])
+            except Exception as e:
+                warnings.warn(f'Could not write profile of {name}: {e}')
+            finally:
+                if trace:
+                    tracemalloc.stop()
+    finally:
+        with _lock:
+            _active = None
+
+def _write_reports(name, stamp, fn, seconds, profiler, trace, workers):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    summary = {'stage': name, 'started': stamp, 'seconds': seconds}
+
+    if profiler is not None:
+        stats = pstats.Stats(profiler)
+        with _lock:
+            for worker in workers:
+                stats.add(worker)
+        stats.dump_stats(f'{fn}.prof')
+        with open(f'{fn}.txt', 'w') as f:
+            stats.stream = f
+            stats.sort_stats('cumulative').print_stats(30)
+    if trace:
+        snapshot = tracemalloc.take_snapshot()
+        summary['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+        with open(f'{fn}-memory.txt', 'w') as f:
+            for stat in snapshot.statistics('lineno')[:30]:
+                f.write(f'{stat}\n')
+
+    with open(f'{PROFILE_DIR}/summary.jsonl', 'a') as f:
+        f.write(json.dumps(summary) + '\n')
+    print(f'Profiled {name}: {summary}')
+
+@contextlib.contextmanager
+def profile_worker():
+    """
+    A context manager for code running in a worker thread of a
+    profiled stage. Its cProfile statistics are merged into the
+    report of the stage. From Python 3.12 on, the profiler of the
+    stage already sees the worker threads and nothing is done.
+    """
+    with _lock:
+        stage = _active
+    if stage is None or 'cprofile' not in PROFILE or PROFILER_SEES_THREADS \
+       or stage['thread'] == threading.get_ident():
+        yield
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler is active, run the worker unprofiled
+        yield
+        return
+    try:
+        yield
+    finally:
+        profiler.disable()
+        with _lock:
+            stage['profilers'].append(profiler)
+
+def profiled(func):
+    """A decorator that profiles every call of func as a stage."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with profile(f'{func.__module__}.{func.__name__}'):
+            return func(*args, **kwargs)
+    return wrapper
+
+def profiled_worker(func):
+    """A decorator that runs func under profile_worker()."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with profile_worker():
+            return func(*args, **kwargs)
+    return wrapper
@@ -5,8 +5,16 @@ import datetime
 import warnings
 import time
 import glob
+import threading
+import collections
 import pandas as pd
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from conversations import build_index, load_fetched, save_fetched, \
+                          select_conversations
+from profiling import profiled, profiled_worker
+
 class ApiError(Exception):
     """
     This is an empty class to raise custom exceptions 
@@ -332,7 +340,284 @@ def download_and_save_nhsuk_tweets(token_file_path='bearer_token.txt',
                                         save_file=save_file)
     return df
 
-def get_conversation(CONV_ID, BEARER_TOKEN, PARAMS, verbose=True):
+class RateLimiter:
+    """
+    A thread-safe sliding-window rate limiter that is shared by
+    all workers hitting the same Twitter API endpoint. A call to
+    wait() blocks until a request can be sent without exceeding
+    max_requests within the last window seconds. If the API
+    signals an exhausted window (status code 429), pause_until()
+    blocks all workers until the window is reset.
+    
+    Parameters
+    ----------
+    max_requests : int
+        The number of requests permitted per window. Defaults to
+        900 (GET /2/users/:id/tweets).
+    window : float
+        The length of the rate limit window in seconds. Defaults
+        to 900 (15 minutes).
+    """
+    def __init__(self, max_requests=900, window=900):
+        self.max_requests = max_requests
+        self.window = window
+        self._sent = collections.deque()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                while self._sent and now - self._sent[0] >= self.window:
+                    self._sent.popleft()
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                elif len(self._sent) < self.max_requests:
+                    self._sent.append(now)
+                    return
+                else:
+                    delay = self.window - (now - self._sent[0])
+            time.sleep(delay)
+
+    def pause_until(self, reset_time):
+        with self._lock:
+            self._paused_until = max(self._paused_until, reset_time)
+
+class PageStore:
+    """
+    A thread-safe, append-only store that streams API result pages
+    into a single JSON lines file (one page per line). Each stored
+    page keeps the 'data', 'includes' and 'meta' keys returned by
+    the API and is tagged with the keys passed to write(), e.g. the
+    'account_id' of a timeline or the 'conversation_id' of a 
+    conversation.
+    
+    Parameters
+    ----------
+    file_path : str
+        The JSON lines file pages are appended to. Defaults to
+        'json/timelines.jsonl'.
+    """
+    def __init__(self, file_path='json/timelines.jsonl'):
+        self.file_path = file_path
+        self._lock = threading.Lock()
+        self._handle = open(file_path, 'a')
+
+    def write(self, page, **tags):
+        tags = {k: str(v) for k, v in tags.items()}
+        line = json.dumps(dict(page, **tags), ensure_ascii=False)
+        with self._lock:
+            self._handle.write(line + '\n')
+            self._handle.flush()
+
+    def close(self):
+        with self._lock:
+            self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+@profiled_worker
+def crawl_account_timeline(ACCOUNT_ID, BEARER_TOKEN, PARAMS, limiter, store,
+                           max_requests=32, max_retries=5):
+    """
+    A subroutine of crawl_account_timelines() that paginates the 
+    GET /2/users/:id/tweets endpoint for a single account and 
+    streams every result page into a shared PageStore. Unlike
+    get_most_recent_tweets_account(), it does not mutate PARAMS,
+    waits on a shared RateLimiter instead of sleeping for a fixed
+    time, and retries rate-limited (429) and server-side (5xx)
+    errors. Since it runs in parallel with other accounts, it 
+    never raises but reports the outcome of the download.
+    
+    Parameters
+    ----------
+    ACCOUNT_ID : str
+        A Twitter user ID.
+    BEARER_TOKEN : str
+        A Twitter API bearer token.
+    PARAMS : dict
+        A dictionary parsed to the header of the API URL request.
+    limiter : RateLimiter
+        The rate limiter shared by all workers.
+    store : PageStore
+        The store result pages are written to.
+    max_requests : int
+        The maximum number of pages to request. Defaults to 32
+        (3,200 most recent tweets).
+    max_retries : int
+        The number of retries per page after failed or
+        rate-limited (429) requests. Defaults to 5.
+        
+    Returns
+    -------
+    tuple
+        A tuple (ACCOUNT_ID, ok, n_tweets, message) where ok
+        indicates whether the timeline was downloaded completely.
+    """
+    params = {k: v for k, v in PARAMS.items() if k != 'pagination_token'}
+    s = requests.Session()
+    s.headers.update({'Authorization': f'Bearer {BEARER_TOKEN}'})
+    URL = f"https://api.twitter.com/2/users/{ACCOUNT_ID}/tweets"
+    request_count = 0
+    n_tweets = 0
+    retries = 0
+    
+    while request_count < max_requests:
+        limiter.wait()
+        try:
+            req = s.get(URL, params=params, timeout=60)
+        except requests.RequestException as e:
+            req = None
+            error = f'request failed -- {e}'
+        
+        if req is not None and req.status_code == 429:
+            # Give up if the limit does not recover (e.g. usage cap hit)
+            retries += 1
+            if retries > max_retries:
+                return ACCOUNT_ID, False, n_tweets, \
+                       f'status code 429 after {max_retries} retries'
+            # Block all workers until the rate limit window resets, 
+            # but at least for a minute if the reset lies in the past
+            reset = req.headers.get('x-rate-limit-reset')
+            reset = float(reset) if reset else 0
+            limiter.pause_until(max(reset + 1, time.time() + 60))
+            continue
+        
+        if req is None or req.status_code >= 500:
+            if req is not None:
+                error = f'status code {req.status_code}'
+            retries += 1
+            if retries > max_retries:
+                return ACCOUNT_ID, False, n_tweets, error
+            time.sleep(2 ** retries)
+            continue
+        
+        if req.status_code != 200:
+            return ACCOUNT_ID, False, n_tweets, \
+                   f'status code {req.status_code} message {req.content}'
+        
+        try:
+            page = json.loads(req.content)
+        except ValueError:
+            return ACCOUNT_ID, False, n_tweets, 'JSON content not loaded'
+        retries = 0
+        
+        if 'data' not in page or 'meta' not in page:
+            break
+        store.write(page, account_id=ACCOUNT_ID)
+        n_tweets += page['meta'].get('result_count', len(page['data']))
+        request_count += 1
+        
+        if 'next_token' not in page['meta']:
+            break
+        params['pagination_token'] = page['meta']['next_token']
+    
+    return ACCOUNT_ID, True, n_tweets, f'{request_count} pages downloaded'
+
+@profiled
+def crawl_account_timelines(ACCOUNT_IDS, BEARER_TOKEN, PARAMS, n_workers=8,
+                            store_path='json/timelines.jsonl',
+                            done_uids=None, verbose=True):
+    """
+    A concurrent routine to download the most recent tweets of
+    many accounts through the crawl_account_timeline() function.
+    A pool of n_workers threads paginates several accounts at once
+    while sharing the 900 requests per 15-minute window of the
+    GET /2/users/:id/tweets endpoint through a single RateLimiter.
+    All pages are streamed into one JSON lines file. Failures are
+    isolated per account: they are logged to download_log.txt and
+    the affected account is not marked as done, so that it is 
+    retried in the next run. For more information go to the 
+    documentation of crawl_account_timeline() via 
+    help(crawl_account_timeline).
+    
+    Parameters
+    ----------
+    ACCOUNT_IDS : iterable
+        An iterable holding the Twitter user IDs to download.
+    BEARER_TOKEN : str
+        A Twitter API bearer token.
+    PARAMS : dict
+        A dictionary parsed to the header of the API URL request.
+    n_workers : int
+        The number of accounts downloaded in parallel. Defaults
+        to 8.
+    store_path : str
+        The JSON lines file pages are appended to. Defaults to
+        'json/timelines.jsonl'.
+    done_uids : list
+        A list of user IDs (as strings) that were already 
+        downloaded and will be skipped. Successfully downloaded
+        IDs are appended to it and exported periodically through
+        export_done_uids(). Defaults to None.
+    verbose : bool
+        A boolean indicating whether progress of the download
+        routine should be printed to the console. Defaults to
+        True.
+  
+    Returns
+    -------
+    list
+        The list of successfully downloaded user IDs (as strings),
+        including those passed in done_uids.
+        
+    Raises
+    ------
+    ApiError
+        If the PARAMS argument is malformed (but not
+        invalid) to ensure that the pagination routine
+        works as intended.
+    """
+    if 'max_results' not in PARAMS.keys() or int(PARAMS['max_results']) != 100:
+        raise ApiError('Please ensure that you parse max_results: 100 to '\
+                       'your requests parameters.')
+    
+    done_uids = [] if done_uids is None else done_uids
+    done = set(done_uids)
+    todo = [uid for uid in ACCOUNT_IDS if str(uid) not in done]
+    n_accounts = len(todo)
+    if verbose:
+        print(f'Downloading timelines of {n_accounts} accounts with '\
+              f'{n_workers} workers.')
+    
+    limiter = RateLimiter()
+    try:
+        with PageStore(store_path) as store, \
+             ThreadPoolExecutor(max_workers=n_workers) as pool:
+            futures = {pool.submit(crawl_account_timeline, uid, BEARER_TOKEN, 
+                                   PARAMS, limiter, store): uid 
+                       for uid in todo}
+            for count, future in enumerate(as_completed(futures), start=1):
+                uid = futures[future]
+                try:
+                    uid, ok, n_tweets, message = future.result()
+                except Exception as e:
+                    ok, n_tweets = False, 0
+                    message = f'{type(e).__name__}: {e}'
+                if ok:
+                    done_uids.append(str(uid))
+                else:
+                    with open('download_log.txt', 'a') as f:
+                        f.write(f'Download failed for account {uid} -- '\
+                                f'{message}\n')
+                if verbose:
+                    percent_done = round(count*100/n_accounts, 2)
+                    print(f'Account {uid}: {n_tweets} tweets, {message} '\
+                          f'({percent_done}% done).')
+                if count % 15 == 0:
+                    export_done_uids(done_uids)
+    finally:
+        # Keep finished accounts even if the run is interrupted
+        export_done_uids(done_uids)
+    return done_uids
+
+def get_conversation(CONV_ID, BEARER_TOKEN, PARAMS, verbose=True, 
+                     since_id=None, fetched=None, store=None):
     """
     A subroutine to download all tweets attached to a specific
     conversation ID, including the possibility for pagination.
@@ -360,6 +645,17 @@ def get_conversation(CONV_ID, BEARER_TOKEN, PARAMS, verbose=True):
         routine should be printed to the console. Defaults to
         True. Does not affect warnings raised after malformed
         API returns.
+    since_id : str
+        If given, only tweets newer than this tweet ID are
+        downloaded. Defaults to None.
+    fetched : dict
+        A download log (see conversations.load_fetched()) in which
+        the newest tweet ID, the time of download and the number 
+        of downloaded tweets are recorded after a successful 
+        download. Defaults to None.
+    store : PageStore
+        If given, every result page is also appended to the store,
+        tagged with the conversation_id. Defaults to None.
   
     Returns
     -------
@@ -388,6 +684,12 @@ def get_conversation(CONV_ID, BEARER_TOKEN, PARAMS, verbose=True):
     s.headers.update({'Authorization': f'Bearer {BEARER_TOKEN}'})
     URL = f"https://api.twitter.com/2/tweets/search/all"\
           f"?query=conversation_id:{CONV_ID}"
+    # Replies downloaded earlier are kept in the count of the log
+    n_before = 0
+    if since_id:
+        URL += f"&since_id={since_id}"
+        if fetched is not None and str(CONV_ID) in fetched:
+            n_before = fetched[str(CONV_ID)][2]
     
     returned_less_than_500_tweets = False
     request_count = 0
@@ -408,16 +710,23 @@ def get_conversation(CONV_ID, BEARER_TOKEN, PARAMS, verbose=True):
             return pd.DataFrame()
 
         page = json.loads(req.content)
+        if store is not None and 'data' in page:
+            store.write(page, conversation_id=CONV_ID)
         
         if page['meta']['result_count'] == 0 and request_count == 0:
             if verbose:
                 print(f'No results found for {CONV_ID}! Returning empty '\
                       f'data frame.')
+            if fetched is not None:
+                fetched[str(CONV_ID)] = [int(since_id or 0), time.time(),
+                                         n_before]
             return pd.DataFrame()
         
         # If it is the first request, initialize data frame
         if request_count == 0: # first request, initialize df
             df = pd.json_normalize(page['data'])
+            # Results are sorted from newest to oldest
+            newest_id = page['meta'].get('newest_id', page['data'][0]['id'])
         # Else append results to existing data frame
         else: 
             df = df.append(pd.json_normalize(page['data']))
@@ -433,10 +742,15 @@ def get_conversation(CONV_ID, BEARER_TOKEN, PARAMS, verbose=True):
         
         request_count += 1
     
+    if fetched is not None:
+        fetched[str(CONV_ID)] = [int(newest_id), time.time(), 
+                                 n_before + len(df)]
     return df
     
+@profiled
 def get_conversations(CONV_ID_ARRAY, BEARER_TOKEN, PARAMS, verbose=True, 
-                      save_file=True, reference='NHSUK'):
+                      save_file=True, reference='NHSUK', since_ids=None,
+                      fetched=None, store=None):
     """
     A routine to download, combine, and save all 
     conversations in an array of conversation IDs through the
@@ -466,6 +780,16 @@ def get_conversations(CONV_ID_ARRAY, BEARER_TOKEN, PARAMS, verbose=True,
     reference : str
         A string reference to be included in the csv file to
         which the results are written. Defaults to 'NHSUK'.
+    since_ids : dict
+        Conversation ID -> tweet ID after which tweets are
+        downloaded (None for full downloads). Defaults to None.
+    fetched : dict
+        A download log (see conversations.load_fetched()) that
+        is updated and saved every 50 conversations. Defaults 
+        to None.
+    store : PageStore
+        If given, all result pages are also appended to the
+        store. Defaults to None.
   
     Returns
     -------
@@ -482,6 +806,7 @@ def get_conversations(CONV_ID_ARRAY, BEARER_TOKEN, PARAMS, verbose=True,
         invalid) to ensure that the pagination routine
         works as intended.
     """
+    since_ids = dict() if since_ids is None else since_ids
     # Initialize list of data frames holding data frames
     # representing indiviudal conversations and 
     # progress tracking variables.
@@ -492,15 +817,21 @@ def get_conversations(CONV_ID_ARRAY, BEARER_TOKEN, PARAMS, verbose=True,
         if verbose:
             print(f'Downloading conversation {CONV_ID}.')
         # Run subroutine for conversation ID
-        df = get_conversation(CONV_ID, BEARER_TOKEN, PARAMS)
+        df = get_conversation(CONV_ID, BEARER_TOKEN, PARAMS, 
+                              since_id=since_ids.get(CONV_ID), 
+                              fetched=fetched, store=store)
         dfs.append(df)
+        if fetched is not None and count % 50 == 0:
+            save_fetched(fetched)
         if verbose:
             percent_done = round(count*100/n_convs,2)
             print(f'Downloaded conversation {CONV_ID} and downloaded '\
                   f'{percent_done}%!')
         count += 1
+    if fetched is not None:
+        save_fetched(fetched)
     # Combine results into a single data frame
-    res = pd.concat(dfs)
+    res = pd.concat(dfs) if len(dfs) > 0 else pd.DataFrame()
     if save_file:
         fn = f"Conversations_{reference}_"\
              f"{datetime.datetime.now().strftime('%Y-%m-%d_%H:%M:%S')}.csv"
@@ -511,13 +842,24 @@ def get_conversations(CONV_ID_ARRAY, BEARER_TOKEN, PARAMS, verbose=True,
 def extract_and_download_conversation_ids(df, 
                                           token_file_path='bearer_token.txt',
                                           verbose=True, save_file=True, 
-                                          reference='NHSUK'):
+                                          reference='NHSUK', folder='json',
+                                          max_age_days=7, 
+                                          max_activity_days=90):
     """
     A wrapper function to extract all unique 
     conversation IDs from a data frame with tweets
     (in the case of this study, the 3,200 most recent NHSUK tweets)
     and then call the get_conversations() routine to
-    download all of these conversations.
+    download the conversations that are missing or stale.
+    
+    Conversations are selected against an index of all tweets 
+    stored in folder and the log of earlier downloads (see
+    conversations.select_conversations()): conversations that
+    consist of a stored root tweet without replies are skipped, 
+    and downloaded conversations are only checked for new replies
+    (through the since_id of the newest downloaded tweet) if stored
+    tweets show new activity. Downloaded pages are appended to
+    folder/conversations.jsonl so that the index includes them.
     
     For more information 
     go to the documentation of these functions
@@ -546,6 +888,14 @@ def extract_and_download_conversation_ids(df,
     reference : str
         A string reference to be included in the csv file to
         which the results are written. Defaults to 'NHSUK'.
+    folder : str
+        The folder holding the downloaded pages. Defaults to 'json'.
+    max_age_days : float
+        The number of days after which a downloaded conversation
+        is checked for new replies again. Defaults to 7.
+    max_activity_days : float
+        Conversations without any tweet in this number of days are
+        not checked for new replies anymore. Defaults to 90.
   
     Returns
     -------
@@ -571,10 +921,18 @@ def extract_and_download_conversation_ids(df,
     n_convs = len(conv_ids)
     print(f'Found {n_convs} unique conversation IDs!')
     
+    # Only download conversations that are missing or stale
+    fetched = load_fetched()
+    since_ids = select_conversations(conv_ids, build_index(folder), fetched,
+                                     max_age_days=max_age_days,
+                                     max_activity_days=max_activity_days)
+    print(f'{len(since_ids)} conversations are missing or stale!')
+    
     # Specify API parameters
     PARAMS = {
         "max_results": "500", # maximum number of results permitted
-        "tweet.fields": "author_id,created_at,text,conversation_id",
+        "tweet.fields": "author_id,created_at,text,conversation_id,"\
+                        "referenced_tweets,public_metrics",
         "expansions":  "referenced_tweets.id"
     }
     
@@ -582,9 +940,12 @@ def extract_and_download_conversation_ids(df,
     BEARER_TOKEN = read_bearer_token(token_file_path)
 
     # Download conversations
-    df_conv = get_conversations(conv_ids, BEARER_TOKEN, PARAMS, 
-                                verbose=verbose, save_file=save_file, 
-                                reference=reference)
+    with PageStore(f'{folder}/conversations.jsonl') as store:
+        df_conv = get_conversations(list(since_ids), BEARER_TOKEN, PARAMS, 
+                                    verbose=verbose, save_file=save_file, 
+                                    reference=reference, 
+                                    since_ids=since_ids, fetched=fetched,
+                                    store=store)
     return df_conv
 
 BEARER_TOKEN = read_bearer_token()